@@ -8,8 +8,9 @@ import argparse
 import binascii
 import bitcoin
 import bitcoin.rpc
+import heapq
 import logging
-import math
+import re
 import time
 
 from bitcoin.core import b2x, b2lx, x, lx, str_money_value, COIN, CMutableTransaction, CMutableTxIn, CMutableTxOut
@@ -67,10 +68,98 @@ if args.testnet:
 
 rpc = bitcoin.rpc.Proxy()
 
+def estimate_scriptSig_size(unspent):
+    """Estimate the signed scriptSig size of an unspent txout
+
+    Only P2PKH with a compressed pubkey is handled; segwit inputs would also
+    need their witness accounted for, and the pubkey type is only known from
+    the output descriptor. Returns None for anything else.
+    """
+    scriptPubKey = unspent['scriptPubKey']
+    if (len(scriptPubKey) == 25 and scriptPubKey[0:3] == b'\x76\xa9\x14'
+            and scriptPubKey[23:25] == b'\x88\xac'):
+        m = re.match(r'pkh\((?:\[[^\]]*\])?([0-9a-fA-F]+)\)', unspent.get('desc', ''))
+        if m is not None and len(m.group(1)) == 66:
+            # <sig> <compressed pubkey>, assuming the largest DER encoding
+            return 107
+    return None
+
+def wallet_sign(tx):
+    """Sign all inputs of tx with the wallet
+
+    Any placeholder scriptSigs are discarded first.
+    """
+    unsigned_tx = CMutableTransaction.from_tx(tx)
+    for txin in unsigned_tx.vin:
+        txin.scriptSig = CScript()
+    r = rpc.signrawtransactionwithwallet(unsigned_tx)
+    assert(r['complete'])
+    return r['tx']
+
+def fee_for_size(size, feeperkb):
+    """Fee in satoshis for size bytes at feeperkb, rounded up"""
+    return -(-size * feeperkb // 1000)
+
+def select_coins_bnb(candidates, target, cost_of_change, max_tries=100000):
+    """Branch-and-Bound search for a changeless set of inputs
+
+    candidates is a list of (effective_value, unspent) pairs, where the
+    effective value is the amount less the fee needed to spend it. Returns the
+    unspents whose effective values sum to between target and
+    target + cost_of_change with the least excess, or None if no such set was
+    found within max_tries.
+    """
+    candidates = sorted((c for c in candidates if c[0] > 0),
+                        key=lambda c: c[0], reverse=True)
+
+    curr_value = 0
+    curr_available = sum(eff for eff, _ in candidates)
+    curr_selection = []
+    best_selection = None
+    best_excess = None
+
+    if curr_available < target:
+        return None
+
+    for tries in range(max_tries):
+        if (curr_value + curr_available < target
+                or curr_value > target + cost_of_change):
+            backtrack = True
+        elif curr_value >= target:
+            excess = curr_value - target
+            if best_excess is None or excess < best_excess:
+                best_selection = list(curr_selection)
+                best_excess = excess
+                if best_excess == 0:
+                    break
+            backtrack = True
+        else:
+            backtrack = False
+
+        if backtrack:
+            # Put back the candidates we omitted at the end of the branch, then
+            # omit the last one we included instead.
+            while curr_selection and not curr_selection[-1]:
+                curr_selection.pop()
+                curr_available += candidates[len(curr_selection)][0]
+            if not curr_selection:
+                break
+            curr_selection[-1] = False
+            curr_value -= candidates[len(curr_selection) - 1][0]
+        else:
+            eff = candidates[len(curr_selection)][0]
+            curr_selection.append(True)
+            curr_available -= eff
+            curr_value += eff
+
+    if best_selection is None:
+        return None
+    return [c[1] for c, included in zip(candidates, best_selection) if included]
+
 args.dust = int(args.dust * COIN)
 
-feeperbyte1 = args.fee1 / 1000 * COIN
-feeperbyte2 = args.fee2 / 1000 * COIN
+feeperkb1 = int(round(args.fee1 * COIN))
+feeperkb2 = int(round(args.fee2 * COIN))
 
 # Construct payment tx
 payment_address = CBitcoinAddress(args.address)
@@ -81,11 +170,13 @@ change_txout = CMutableTxOut(0, rpc.getnewaddress().to_scriptPubKey())
 tx = CMutableTransaction()
 tx.vout.append(change_txout)
 tx.vout.append(payment_txout)
+value_out = change_txout.nValue + payment_txout.nValue
 
 # Add all undesirable txouts meant to reduce propagation
 if args.op_return:
     op_ret_txout = CMutableTxOut(0, CScript([OP_RETURN, b'\x00unsuccessful double-spend attempt\x00']))
     tx.vout.append(op_ret_txout)
+    value_out += op_ret_txout.nValue
 
 if args.multisig:
     multisig_txout = CMutableTxOut(args.dust,
@@ -93,6 +184,7 @@ if args.multisig:
                         b'\x00'*33,
                      2, OP_CHECKMULTISIG]))
     tx.vout.append(multisig_txout)
+    value_out += multisig_txout.nValue
 
 tx1_nSequence = 0xFFFFFFFF-2 if args.optinrbf else 0xFFFFFFFF
 tx2_nSequence = tx1_nSequence # maybe they should be different in the future?
@@ -101,51 +193,112 @@ for bad_addr in args.bad_addr:
     bad_addr = CBitcoinAddress(bad_addr)
     txout = CMutableTxOut(args.dust, bad_addr.to_scriptPubKey())
     tx.vout.append(txout)
+    value_out += txout.nValue
 
 
-# Add inputs until we meet the fee1 threshold
-unspent = sorted(rpc.listunspent(1), key=lambda x: x['amount'])
+all_unspent = rpc.listunspent(1)
 value_in = 0
-value_out = sum([vout.nValue for vout in tx.vout])
-while (value_in - value_out) / len(tx.serialize()) < feeperbyte1:
-    # What's the delta fee that we need to get to our desired fees per byte at
-    # the current tx size?
-    delta_fee = math.ceil((feeperbyte1 * len(tx.serialize())) - (value_in - value_out))
-
-    logging.debug('Delta fee: %s' % str_money_value(delta_fee))
-
-    # If we simply subtract that from the change outpoint are we still above
-    # the dust threshold?
-    if change_txout.nValue - delta_fee > args.dust:
-        change_txout.nValue -= delta_fee
-        value_out -= delta_fee
-
-    # Do we need to add another input?
-    if value_in - value_out < 0:
-        new_outpoint = unspent[-1]['outpoint']
-        new_amount = unspent[-1]['amount']
-        unspent = unspent[:-1]
 
-        logging.debug('Adding new input %s:%d with value %s BTC' % \
-                (b2lx(new_outpoint.hash), new_outpoint.n,
-                 str_money_value(new_amount)))
-
-        new_txin = CMutableTxIn(new_outpoint, nSequence=tx1_nSequence)
+# First try to find a set of inputs that pays for the outputs and fees with so
+# little left over that the change output can be dropped entirely.
+bnb_candidates = []
+for u in all_unspent:
+    scriptSig_size = estimate_scriptSig_size(u)
+    if scriptSig_size is not None:
+        # outpoint, scriptSig length, scriptSig, nSequence
+        input_fee = fee_for_size(36 + 1 + scriptSig_size + 4, feeperkb1)
+        bnb_candidates.append((u['amount'] - input_fee, u))
+
+# The extra two bytes allow for the input count varint growing.
+changeless_size = len(CMutableTransaction(vin=[], vout=tx.vout[1:]).serialize()) + 2
+bnb_target = value_out + fee_for_size(changeless_size, feeperkb1)
+# Creating the change output, plus at most a P2PKH input to spend it later.
+cost_of_change = (fee_for_size(len(change_txout.serialize()), feeperkb1)
+                  + fee_for_size(36 + 1 + 107 + 4, feeperkb1))
+
+bnb_selection = select_coins_bnb(bnb_candidates, bnb_target, cost_of_change)
+if bnb_selection is not None:
+    # Any excess goes to fees, so make sure the double-spend can still replace
+    # the payment: BIP125 requires it to pay more in absolute fees, by at least
+    # the incremental relay fee for its own size, and at a higher feerate.
+    inputs_size = sum(36 + 1 + estimate_scriptSig_size(u) + 4 for u in bnb_selection)
+    payment_size = changeless_size + inputs_size
+    payment_fee = sum(u['amount'] for u in bnb_selection) - value_out
+
+    doublespend_size = (len(CMutableTransaction(vin=[], vout=[change_txout]).serialize())
+                        + 2 + inputs_size)
+    doublespend_fee = fee_for_size(doublespend_size, feeperkb2)
+    incremental_feeperkb = int(round(rpc.call('getnetworkinfo')['incrementalfee'] * COIN))
+
+    if (doublespend_fee <= payment_fee + fee_for_size(doublespend_size, incremental_feeperkb)
+            or doublespend_fee * payment_size <= payment_fee * doublespend_size):
+        logging.debug('Changeless input set pays too much in fees to double-spend; ignoring it')
+        bnb_selection = None
+
+selected_outpoints = set()
+if bnb_selection is not None:
+    logging.debug('Found changeless set of %d inputs' % len(bnb_selection))
+
+    del tx.vout[0]
+    for new_unspent in bnb_selection:
+        new_txin = CMutableTxIn(new_unspent['outpoint'], nSequence=tx1_nSequence)
+        new_txin.scriptSig = CScript(b'\x00' * estimate_scriptSig_size(new_unspent))
         tx.vin.append(new_txin)
 
-        value_in += new_amount
-        change_txout.nValue += new_amount
-        value_out += new_amount
-
-        # Resign the tx so we can figure out how large the new input's scriptSig will be.
-        r = rpc.signrawtransactionwithwallet(tx)
-        assert(r['complete'])
-
-        tx.vin[-1].scriptSig = r['tx'].vin[-1].scriptSig
-
-r = rpc.signrawtransactionwithwallet(tx)
-assert(r['complete'])
-tx = CMutableTransaction.from_tx(r['tx'])
+        value_in += new_unspent['amount']
+        selected_outpoints.add(new_unspent['outpoint'])
+
+# Inputs are always taken largest first, so a max-heap is all we need.
+unspent = [(-u['amount'], i, u) for i, u in enumerate(all_unspent)
+                                if u['outpoint'] not in selected_outpoints]
+heapq.heapify(unspent)
+
+# Otherwise add inputs until we meet the fee1 threshold
+if bnb_selection is None:
+    # Only the scriptSigs change the serialized size; nValue is always 8 bytes,
+    # so adjusting the change output leaves it untouched.
+    tx_size = len(tx.serialize())
+    while value_in - value_out < fee_for_size(tx_size, feeperkb1):
+        # What's the delta fee that we need to get to our desired fees per byte
+        # at the current tx size?
+        delta_fee = fee_for_size(tx_size, feeperkb1) - (value_in - value_out)
+
+        logging.debug('Delta fee: %s' % str_money_value(delta_fee))
+
+        # If we simply subtract that from the change outpoint are we still above
+        # the dust threshold?
+        if change_txout.nValue - delta_fee > args.dust:
+            change_txout.nValue -= delta_fee
+            value_out -= delta_fee
+
+        # Do we need to add another input?
+        if value_in - value_out < 0:
+            _, _, new_unspent = heapq.heappop(unspent)
+            new_outpoint = new_unspent['outpoint']
+            new_amount = new_unspent['amount']
+
+            logging.debug('Adding new input %s:%d with value %s BTC' % \
+                    (b2lx(new_outpoint.hash), new_outpoint.n,
+                     str_money_value(new_amount)))
+
+            new_txin = CMutableTxIn(new_outpoint, nSequence=tx1_nSequence)
+            tx.vin.append(new_txin)
+
+            value_in += new_amount
+            change_txout.nValue += new_amount
+            value_out += new_amount
+
+            # Use a placeholder scriptSig of the right size if we know what it
+            # will be; the real signature is added once all inputs are in.
+            scriptSig_size = estimate_scriptSig_size(new_unspent)
+            if scriptSig_size is not None:
+                tx.vin[-1].scriptSig = CScript(b'\x00' * scriptSig_size)
+            else:
+                # Resign the tx so we can figure out how large the new input's scriptSig will be.
+                tx.vin[-1].scriptSig = wallet_sign(tx).vin[-1].scriptSig
+            tx_size = len(tx.serialize())
+
+tx = CMutableTransaction.from_tx(wallet_sign(tx))
 
 logging.debug('Payment tx %s' % b2x(tx.serialize()))
 logging.info('Payment tx size: %.3f KB, fees: %s, %s BTC/KB' % \
@@ -165,17 +318,20 @@ if not args.dryrun:
 # create a new proxy in case the old one timed out during sleep
 rpc = bitcoin.rpc.Proxy()
 
-# Double-spend! Remove all but the change output
-tx.vout = tx.vout[0:1]
-change_txout = tx.vout[0]
+# Double-spend! Replace all outputs with a single change output; the payment
+# tx may not have had one at all.
 value_out = value_in
-change_txout.nValue = value_out
+change_txout = CMutableTxOut(value_out, change_txout.scriptPubKey)
+tx.vout = [change_txout]
 
 # FIXME: need to modularize this code
-while (value_in - value_out) / len(tx.serialize()) < feeperbyte2:
+# Only the scriptSigs change the serialized size; nValue is always 8 bytes, so
+# adjusting the change output leaves it untouched.
+tx_size = len(tx.serialize())
+while value_in - value_out < fee_for_size(tx_size, feeperkb2):
     # What's the delta fee that we need to get to our desired fees per byte at
     # the current tx size?
-    delta_fee = math.ceil((feeperbyte2 * len(tx.serialize())) - (value_in - value_out))
+    delta_fee = fee_for_size(tx_size, feeperkb2) - (value_in - value_out)
 
     logging.debug('Delta fee: %s' % str_money_value(delta_fee))
 
@@ -187,9 +343,9 @@ while (value_in - value_out) / len(tx.serialize()) < feeperbyte2:
 
     # Do we need to add another input?
     if value_in - value_out < 0:
-        new_outpoint = unspent[-1]['outpoint']
-        new_amount = unspent[-1]['amount']
-        unspent = unspent[:-1]
+        _, _, new_unspent = heapq.heappop(unspent)
+        new_outpoint = new_unspent['outpoint']
+        new_amount = new_unspent['amount']
 
         logging.debug('Adding new input %s:%d with value %s BTC' % \
                 (b2lx(new_outpoint.hash), new_outpoint.n,
@@ -202,15 +358,17 @@ while (value_in - value_out) / len(tx.serialize()) < feeperbyte2:
         change_txout.nValue += new_amount
         value_out += new_amount
 
-        # Resign the tx so we can figure out how large the new input's scriptSig will be.
-        r = rpc.signrawtransactionwithwallet(tx)
-        assert(r['complete'])
-
-        tx.vin[-1].scriptSig = r['tx'].vin[-1].scriptSig
-
-r = rpc.signrawtransactionwithwallet(tx)
-assert(r['complete'])
-tx = r['tx']
+        # Use a placeholder scriptSig of the right size if we know what it
+        # will be; the real signature is added once all inputs are in.
+        scriptSig_size = estimate_scriptSig_size(new_unspent)
+        if scriptSig_size is not None:
+            tx.vin[-1].scriptSig = CScript(b'\x00' * scriptSig_size)
+        else:
+            # Resign the tx so we can figure out how large the new input's scriptSig will be.
+            tx.vin[-1].scriptSig = wallet_sign(tx).vin[-1].scriptSig
+        tx_size = len(tx.serialize())
+
+tx = wallet_sign(tx)
 
 logging.debug('Double-spend tx %s' % b2x(tx.serialize()))
 logging.info('Double-spend tx size: %.3f KB, fees: %s, %s BTC/KB' % \